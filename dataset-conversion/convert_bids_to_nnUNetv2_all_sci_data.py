@@ -58,19 +58,30 @@ Authors: Naga Karthik, Jan Valosek
 """
 
 import argparse
+import functools
 from pathlib import Path
 import json
 import os
 import re
-import shutil
+import sys
 import yaml
-from collections import OrderedDict
+from collections import Counter, OrderedDict, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 from loguru import logger
 from sklearn.model_selection import train_test_split
-from utils import binarize_label, create_region_based_label, get_git_branch_and_commit, Image, create_multi_channel_label_input
+from utils import binarize_label, create_region_based_label, get_git_branch_and_commit, convert_subject_fused, \
+    reorient_and_save
 from tqdm import tqdm
 import nibabel as nib
 
+# optional faster serializers: LibYAML C bindings and orjson (fall back to the pure-Python/stdlib ones otherwise)
+YAML_DUMPER = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 LABEL_SUFFIXES = {
     "dcm-zurich-lesions": ["label-SC_mask-manual", "label-lesion"],
@@ -86,6 +97,10 @@ LABEL_SUFFIXES = {
 # NOTE: these datasets only contain a few subjects (n<20), hence using them all for training
 TRAIN_ONLY_SITES = ['dcm-zurich-lesions', 'sci-paris', 'site-012', 'site-013']
 TEST_ONLY_SITES = ['site-003', 'site-014']
+# patterns used to find the site identifier in a path
+_DCM_SITE_RE = re.compile(r'dcm-zurich-lesions(-\d{8})?')
+_SCI_SITE_RE = re.compile(r'sci-zurich|sci-colorado|sci-paris')
+_PRAXIS_SITE_RE = re.compile(r'site-\d{3}')
 
 
 def get_parser():
@@ -108,6 +123,9 @@ def get_parser():
     parser.add_argument('--split', nargs='+', type=float, default=[0.8, 0.2],
                         help='Ratios of training (includes validation) and test splits lying between 0-1. Example: '
                              '--split 0.8 0.2')
+    parser.add_argument('--num-workers', default=os.cpu_count(), type=int,
+                        help='Number of worker processes used to convert the subjects in parallel. Default: number of '
+                             'CPUs')
     return parser
 
 
@@ -131,27 +149,6 @@ def get_region_based_label(subject_label_file, subject_image_file, site_name, su
     return combined_seg_file
 
 
-def get_multi_channel_label_input(subject_label_file, subject_image_file, site_name, sub_ses_name, thr=0.5):
-    # define path for sc seg file
-    subject_seg_file = subject_label_file.replace(f'_{LABEL_SUFFIXES[site_name][1]}', f'_{LABEL_SUFFIXES[site_name][0]}')
-
-    # check if the seg file exists
-    if not os.path.exists(subject_seg_file):
-        logger.info(f"Spinal cord segmentation file for subject {sub_ses_name} does not exist. Skipping.")
-        return None
-
-    # create label for the multi-channel training. Here, the label is the SC seg that will be the 2nd channel in the input
-    # along with the image. (we ensure that the lesion seg is part of the spinal cord seg
-    seg_lesion_nii = create_multi_channel_label_input(subject_label_file, subject_seg_file, subject_image_file,
-                                                      sub_ses_name, thr=thr)
-
-    # save the region-based label
-    combined_seg_file = subject_label_file.replace(f'_{LABEL_SUFFIXES[site_name][1]}', '_sc')
-    nib.save(seg_lesion_nii, combined_seg_file)
-
-    return combined_seg_file
-
-
 def create_directories(path_out, site):
     """Create test directories for a specified site.
 
@@ -169,6 +166,7 @@ def create_directories(path_out, site):
             path.mkdir(parents=True, exist_ok=True)
 
 
+@functools.lru_cache(maxsize=None)
 def find_site_in_path(path):
     """Extracts site identifier from the given path.
 
@@ -178,14 +176,15 @@ def find_site_in_path(path):
     Returns:
     str: Extracted site identifier or None if not found.
     """
+    match = None
     # Find 'dcm-zurich-lesions' or 'dcm-zurich-lesions-20231115'
     if 'dcm' in path:
-        match = re.search(r'dcm-zurich-lesions(-\d{8})?', path)
+        match = _DCM_SITE_RE.search(path)
     elif 'sci' in path:
-        match = re.search(r'sci-zurich|sci-colorado|sci-paris', path)
+        match = _SCI_SITE_RE.search(path)
     elif 'site' in path:
         # NOTE: PRAXIS data has 'site-xxx' in the path (and doesn't have the site names themselves in the path)
-        match = re.search(r'site-\d{3}', path)
+        match = _PRAXIS_SITE_RE.search(path)
 
     return match.group(0) if match else None
 
@@ -199,7 +198,7 @@ def create_yaml(train_niftis, test_nifitis, path_out, args, train_ctr, test_ctr,
 
     # write the train and test niftis to a yaml file
     with open(os.path.join(path_out, f"train_test_split_seed{args.seed}.yaml"), "w") as outfile:
-        yaml.dump(niftis_dict, outfile, default_flow_style=False)
+        yaml.dump(niftis_dict, outfile, Dumper=YAML_DUMPER, default_flow_style=False)
 
     # c.f. dataset json generation
     # In nnUNet V2, dataset.json file has become much shorter. The description of the fields and changes
@@ -258,31 +257,137 @@ def create_yaml(train_niftis, test_nifitis, path_out, args, train_ctr, test_ctr,
     json_dict['file_ending'] = ".nii.gz"
 
     # create dataset_description.json
-    json_object = json.dumps(json_dict, indent=4)
+    if orjson is not None:
+        # NOTE: orjson only supports 2-space indentation; OPT_NON_STR_KEYS is needed for the integer channel keys
+        json_object = orjson.dumps(json_dict, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+    else:
+        json_object = json.dumps(json_dict, indent=4).encode()
     # write to dataset description
     # nn-unet requires it to be "dataset.json"
     dataset_dict_name = f"dataset.json"
-    with open(os.path.join(path_out, dataset_dict_name), "w") as outfile:
+    with open(os.path.join(path_out, dataset_dict_name), "wb") as outfile:
         outfile.write(json_object)
 
 
+def _init_worker(log_file):
+    """Re-add the log file sink in each worker process (loguru sinks are not shared across processes)."""
+    logger.remove()
+    logger.add(sys.stderr)
+    logger.add(log_file, level="INFO")
+
+
+def _convert_subject(subject_label_file, subject_image_file, site_name, ctr, out_img_dir, out_lbl_dir, args):
+    """Copy the image and label(s) of a single subject to the nnUNet folders, using the nnUNet naming convention.
+
+    Args:
+    subject_label_file (str): Path to the lesion label of the subject.
+    subject_image_file (str): Path to the image of the subject.
+    site_name (str): Site identifier of the subject.
+    ctr (int): Index of the subject within its split.
+    out_img_dir (Path): Output directory for the images (e.g., imagesTr).
+    out_lbl_dir (Path): Output directory for the labels (e.g., labelsTr).
+    args (argparse.Namespace): Parsed command line arguments.
+
+    Returns:
+    str: Basename of the subject image or None if the subject was skipped.
+    """
+    # create the new convention names for nnunet
+    basename = os.path.basename(subject_image_file)
+    sub_name = basename[:-len('.nii.gz')]
+    prefix = f"{args.dataset_name}_{site_name}_{sub_name}_{ctr:03d}"
+
+    subject_image_file_nnunet = os.path.join(out_img_dir, f"{prefix}_0000.nii.gz")
+    subject_label_file_nnunet = os.path.join(out_lbl_dir, f"{prefix}.nii.gz")
+
+    if args.multichannel:
+        # channel 0: image, channel 1: SC seg
+        subject_sc_file_nnunet = os.path.join(out_img_dir, f"{prefix}_0001.nii.gz")
+
+        # define path for sc seg file
+        subject_seg_file = subject_label_file.replace(f'_{LABEL_SUFFIXES[site_name][1]}',
+                                                      f'_{LABEL_SUFFIXES[site_name][0]}')
+        # check if the seg file exists
+        if not os.path.exists(subject_seg_file):
+            logger.info(f"Spinal cord segmentation file for subject {sub_name} does not exist. Skipping.")
+            print(f"Skipping since the multi-channel label could not be generated")
+            return None
+
+        # load the image, lesion seg and SC seg once, and save the RPI-reoriented image, SC seg (which includes the
+        # lesion seg) and binarized lesion seg
+        convert_subject_fused(subject_image_file, subject_label_file, subject_seg_file,
+                              subject_image_file_nnunet, subject_sc_file_nnunet, subject_label_file_nnunet, thr=0.5)
+
+        return basename
+
+    # use region-based labels if required
+    elif args.region_based:
+        # overwritten the subject_label_file with the region-based label
+        subject_label_file = get_region_based_label(subject_label_file, subject_image_file,
+                                                    site_name, sub_name, thr=0.5)
+        if subject_label_file is None:
+            print(f"Skipping since the region-based label could not be generated")
+            return None
+
+    # reorient the image and label to RPI and save them to the new structure
+    reorient_and_save(subject_image_file, subject_image_file_nnunet)
+    reorient_and_save(subject_label_file, subject_label_file_nnunet)
+
+    # don't binarize the label if the region-based training is set
+    if not args.region_based:
+        binarize_label(subject_image_file_nnunet, subject_label_file_nnunet)
+
+    return basename
+
+
+def _process_subject(subject_label_file, split, idx, args, paths):
+    """Convert a single subject to the nnUNet format.
+
+    Args:
+    subject_label_file (str): Path to the lesion label of the subject.
+    split (str): Either 'train' or 'test'.
+    idx (int): Index of the subject within its split, used to build deterministic nnUNet filenames.
+    args (argparse.Namespace): Parsed command line arguments.
+    paths (dict): Output (images, labels) directories; 'train' maps to a tuple and 'test' to a dict of tuples keyed by
+    site.
+
+    Returns:
+    tuple: (split, basename of the subject image, True if the subject was converted successfully)
+    """
+    site_name = find_site_in_path(subject_label_file)
+    # Construct path to the background image
+    subject_image_file = subject_label_file.replace('/derivatives/labels', '').replace(f'_{LABEL_SUFFIXES[site_name][1]}', '')
+
+    if split == 'train':
+        out_img_dir, out_lbl_dir = paths['train']
+    else:
+        out_img_dir, out_lbl_dir = paths['test'][site_name]
+
+    basename = _convert_subject(subject_label_file, subject_image_file, site_name, idx, out_img_dir, out_lbl_dir, args)
+
+    return split, os.path.basename(subject_image_file), basename is not None
+
+
 def main():
     parser = get_parser()
     args = parser.parse_args()
 
+    if args.multichannel and args.region_based:
+        raise ValueError("Multi-channel input is not supported with region-based labels.")
+
     train_ratio, test_ratio = args.split
-    path_out = Path(os.path.join(os.path.abspath(args.path_out), f'Dataset{args.dataset_number}_{args.dataset_name}'))
+    path_out = Path(os.path.abspath(args.path_out)) / f'Dataset{args.dataset_number}_{args.dataset_name}'
 
     # create individual directories for train and test images and labels
-    path_out_imagesTr = Path(os.path.join(path_out, 'imagesTr'))
-    path_out_labelsTr = Path(os.path.join(path_out, 'labelsTr'))
+    path_out_imagesTr = path_out / 'imagesTr'
+    path_out_labelsTr = path_out / 'labelsTr'
     # create the training directories
-    Path(path_out).mkdir(parents=True, exist_ok=True)
-    Path(path_out_imagesTr).mkdir(parents=True, exist_ok=True)
-    Path(path_out_labelsTr).mkdir(parents=True, exist_ok=True)
+    path_out.mkdir(parents=True, exist_ok=True)
+    path_out_imagesTr.mkdir(parents=True, exist_ok=True)
+    path_out_labelsTr.mkdir(parents=True, exist_ok=True)
 
     # save output to a log file
-    logger.add(os.path.join(path_out, "logs.txt"), rotation="10 MB", level="INFO")
+    path_log = path_out / "logs.txt"
+    logger.add(path_log, rotation="10 MB", level="INFO")
 
     # Check if dataset paths exist
     for path in args.path_data:
@@ -291,15 +396,16 @@ def main():
 
     # Get sites from the input paths
     sites = set(find_site_in_path(path) for path in args.path_data if find_site_in_path(path))
-    # Single site
-    if len(sites) == 1:
-        create_directories(path_out, sites.pop())
-    # Multiple sites
-    else:
-        for site in sites:
-            create_directories(path_out, site)
+    for site in sites:
+        create_directories(path_out, site)
+    # output directories for the train images and the test images of each site
+    paths = {
+        'train': (path_out_imagesTr, path_out_labelsTr),
+        'test': {site: (path_out / f'imagesTs_{site}', path_out / f'labelsTs_{site}') for site in sites},
+    }
 
-    all_lesion_files, train_images, test_images = [], {}, {}
+    # NOTE: lists (and not sets) to keep the order of the subjects, and thus the nnUNet filenames, deterministic
+    train_images, test_images = [], []
     # temp dict for storing dataset commits
     dataset_commits = {}
 
@@ -316,13 +422,16 @@ def main():
         # get recursively all GT '_label-lesion' files
         lesion_label_suffix = LABEL_SUFFIXES[site_name][1]
         lesion_files = [str(path) for path in root.rglob(f'*_{lesion_label_suffix}.nii.gz')]
-        # add to the list of all subjects
-        all_lesion_files.extend(lesion_files)
+        # group the lesion files by subject (in a single pass) to avoid scanning all the files for each subject
+        lesion_files_per_sub = defaultdict(list)
+        for lesion_file in lesion_files:
+            sub = next((part for part in Path(lesion_file).relative_to(root).parts if part.startswith('sub-')), None)
+            lesion_files_per_sub[sub].append(lesion_file)
 
         # Get the training and test splits
         # NOTE: we need a patient-wise split (not image-wise split) to ensure that the same patient is not present in both
         # training and test sets
-        subs = sorted([sub for sub in os.listdir(os.path.join(root, 'derivatives', 'labels'))])
+        subs = sorted([sub for sub in os.listdir(root / 'derivatives' / 'labels')])
         tr_subs, te_subs = train_test_split(subs, test_size=test_ratio, random_state=args.seed)
 
         if site_name in TRAIN_ONLY_SITES:
@@ -342,25 +451,21 @@ def main():
 
         for sub in tr_subs:
             # get the lesion files for the subject
-            lesion_files_sub = [file for file in lesion_files if sub in file]
-
-            for lesion_file in lesion_files_sub:
+            for lesion_file in lesion_files_per_sub.get(sub, []):
                 if not os.path.exists(lesion_file):
                     logger.info(f"Lesion file {lesion_file} does not exist. Skipping.")
                     continue
                 # add the lesion file to the training set
-                train_images[lesion_file] = lesion_file
+                train_images.append(lesion_file)
 
         for sub in te_subs:
             # get the lesion files for the subject
-            lesion_files_sub = [file for file in lesion_files if sub in file]
-
-            for lesion_file in lesion_files_sub:
+            for lesion_file in lesion_files_per_sub.get(sub, []):
                 if not os.path.exists(lesion_file):
                     logger.info(f"Lesion file {lesion_file} does not exist. Skipping.")
                     continue
                 # add the lesion file to the test set
-                test_images[lesion_file] = lesion_file
+                test_images.append(lesion_file)
 
     logger.info(f"Found subjects in the training set (combining all datasets): {len(train_images)}")
     logger.info(f"Found subjects in the test set (combining all datasets): {len(test_images)}")
@@ -374,172 +479,46 @@ def main():
     for dataset_name, dataset_commit in dataset_commits.items():
         logger.info(f"{dataset_name} dataset version: {dataset_commit}")
 
-    # Counters for train and test sets
-    train_ctr, test_ctr = 0, 0
-    train_niftis, test_nifitis = [], []
-    # Loop over all images
-    for subject_label_file in tqdm(all_lesion_files, desc="Iterating over all images"):
-
-        site_name = find_site_in_path(subject_label_file)
-        # Construct path to the background image
-        subject_image_file = subject_label_file.replace('/derivatives/labels', '').replace(f'_{LABEL_SUFFIXES[site_name][1]}', '')
-
-        # Train images
-        if subject_label_file in train_images.keys():
-
-            train_ctr += 1
-            # add the subject image file to the list of training niftis
-            train_niftis.append(os.path.basename(subject_image_file))
+    # Assign the train/test split and the index within the split before dispatching, so that each worker writes to
+    # a deterministic filename without any shared state
+    jobs = [(subject_label_file, 'train', ctr) for ctr, subject_label_file in enumerate(train_images, start=1)]
+    jobs += [(subject_label_file, 'test', ctr) for ctr, subject_label_file in enumerate(test_images, start=1)]
 
-            # create the new convention names for nnunet
-            sub_name = f"{str(Path(subject_image_file).name).replace('.nii.gz', '')}"
-
-            subject_image_file_nnunet = os.path.join(path_out_imagesTr,
-                                                        f"{args.dataset_name}_{site_name}_{sub_name}_{train_ctr:03d}_0000.nii.gz")
-            subject_label_file_nnunet = os.path.join(path_out_labelsTr,
-                                                    f"{args.dataset_name}_{site_name}_{sub_name}_{train_ctr:03d}.nii.gz")
-
-            if args.multichannel:
-                if args.region_based:
-                    raise ValueError("Multi-channel input is not supported with region-based labels.")
-
-                # channel 0: image, channel 1: SC seg
-                subject_sc_file_nnunet = os.path.join(path_out_imagesTr,
-                                                      f"{args.dataset_name}_{site_name}_{sub_name}_{train_ctr:03d}_0001.nii.gz")
-
-                # overwritten the subject_sc_file_nnunet with the label for multi-channel training (lesion is part of SC)
-                subject_sc_file = get_multi_channel_label_input(subject_label_file, subject_image_file,
-                                                                site_name, sub_name, thr=0.5)
-
-                if subject_sc_file is None:
-                    print(f"Skipping since the multi-channel label could not be generated")
-                    continue
-
-            # use region-based labels if required
-            elif args.region_based:
-                # overwritten the subject_label_file with the region-based label
-                subject_label_file = get_region_based_label(subject_label_file, subject_image_file,
-                                                            site_name, sub_name, thr=0.5)
-                if subject_label_file is None:
-                    print(f"Skipping since the region-based label could not be generated")
-                    continue
-
-            # copy the files to new structure
-            shutil.copyfile(subject_image_file, subject_image_file_nnunet)
-            shutil.copyfile(subject_label_file, subject_label_file_nnunet)
-
-            # convert the image and label to RPI using the Image class
-            image = Image(subject_image_file_nnunet)
-            image.change_orientation("RPI")
-            image.save(subject_image_file_nnunet)
-
-            label = Image(subject_label_file_nnunet)
-            label.change_orientation("RPI")
-            label.save(subject_label_file_nnunet)
-
-            if args.multichannel:
-                shutil.copyfile(subject_sc_file, subject_sc_file_nnunet)
-                # convert the SC seg to RPI using the Image class
-                sc_image = Image(subject_sc_file_nnunet)
-                sc_image.change_orientation("RPI")
-                sc_image.save(subject_sc_file_nnunet)
-
-            # don't binarize the label if either of the region-based or multi-channel training is set
-            if not args.region_based:
-                binarize_label(subject_image_file_nnunet, subject_label_file_nnunet)
-
-        # Test images
-        elif subject_label_file in test_images:
-
-            test_ctr += 1
-            # add the image file to the list of testing niftis
-            test_nifitis.append(os.path.basename(subject_image_file))
-
-            # create the new convention names for nnunet
-            sub_name = f"{str(Path(subject_image_file).name).replace('.nii.gz', '')}"
-
-            subject_image_file_nnunet = os.path.join(Path(path_out,
-                                                          f'imagesTs_{find_site_in_path(test_images[subject_label_file])}'),
-                                                     f'{args.dataset_name}_{site_name}_{sub_name}_{test_ctr:03d}_0000.nii.gz')
-            subject_label_file_nnunet = os.path.join(Path(path_out,
-                                                          f'labelsTs_{find_site_in_path(test_images[subject_label_file])}'),
-                                                     f'{args.dataset_name}_{site_name}_{sub_name}_{test_ctr:03d}.nii.gz')
-
-            if args.multichannel:
-                if args.region_based:
-                    raise ValueError("Multi-channel input is not supported with region-based labels.")
-
-                # channel 0: image, channel 1: SC seg
-                subject_sc_file_nnunet = os.path.join(Path(path_out,
-                                                          f'imagesTs_{find_site_in_path(test_images[subject_label_file])}'),
-                                                     f'{args.dataset_name}_{site_name}_{sub_name}_{test_ctr:03d}_0001.nii.gz')
-
-                # overwritten the subject_sc_file_nnunet with the label for multi-channel training (lesion is part of SC)
-                subject_sc_file = get_multi_channel_label_input(subject_label_file, subject_image_file,
-                                                                site_name, sub_name, thr=0.5)
-
-                if subject_sc_file is None:
-                    print(f"Skipping since the multi-channel label could not be generated")
-                    continue
-
-            # use region-based labels if required
-            elif args.region_based:
-                # overwritten the subject_label_file with the region-based label
-                subject_label_file = get_region_based_label(subject_label_file, subject_image_file,
-                                                            site_name, sub_name, thr=0.5)
-                if subject_label_file is None:
-                    continue
-
-            # copy the files to new structure
-            shutil.copyfile(subject_image_file, subject_image_file_nnunet)
-            shutil.copyfile(subject_label_file, subject_label_file_nnunet)
-            # print(f"\nCopying {subject_image_file} to {subject_image_file_nnunet}")
-            # convert the image and label to RPI using the Image class
-            image = Image(subject_image_file_nnunet)
-            image.change_orientation("RPI")
-            image.save(subject_image_file_nnunet)
-
-            label = Image(subject_label_file_nnunet)
-            label.change_orientation("RPI")
-            label.save(subject_label_file_nnunet)
-
-            if args.multichannel:
-                shutil.copyfile(subject_sc_file, subject_sc_file_nnunet)
-                # convert the SC seg to RPI using the Image class
-                sc_image = Image(subject_sc_file_nnunet)
-                sc_image.change_orientation("RPI")
-                sc_image.save(subject_sc_file_nnunet)
-
-            # don't binarize the label if either of the region-based or multi-channel training is set
-            if not args.region_based:
-                binarize_label(subject_image_file_nnunet, subject_label_file_nnunet)
-
-        else:
-            print("Skipping file, could not be located in the Train or Test splits split.", subject_label_file)
+    # Convert the subjects in parallel
+    # NOTE: the subjects skipped during the conversion (e.g., missing SC seg) are neither listed in the yaml file nor
+    # counted in dataset.json
+    train_niftis, test_nifitis = [], []
+    train_converted, test_converted = [], []
+    label_files, splits, idxs = zip(*jobs) if jobs else ((), (), ())
+    with ProcessPoolExecutor(max_workers=args.num_workers, initializer=_init_worker,
+                             initargs=(path_log,)) as executor:
+        results = executor.map(_process_subject, label_files, splits, idxs, repeat(args), repeat(paths),
+                               chunksize=4)
+        results = tqdm(results, total=len(jobs), desc="Iterating over all images")
+        # NOTE: executor.map returns the results in the order of the jobs; `results` comes first in zip() so that the
+        # progress bar is exhausted (i.e., completed and closed) before zip() stops
+        for (split, basename, ok), subject_label_file in zip(results, label_files):
+            if not ok:
+                continue
+            if split == 'train':
+                train_niftis.append(basename)
+                train_converted.append(subject_label_file)
+            else:
+                test_nifitis.append(basename)
+                test_converted.append(subject_label_file)
+    train_ctr, test_ctr = len(train_niftis), len(test_nifitis)
 
     logger.info(f"----- Dataset conversion finished! -----")
     logger.info(f"Number of training and validation images (across all sites): {train_ctr}")
     # Get number of train and val images per site
-    train_images_per_site = {}
-    for train_subject in train_images:
-        site = find_site_in_path(train_subject)
-        if site in train_images_per_site:
-            train_images_per_site[site] += 1
-        else:
-            train_images_per_site[site] = 1
+    train_images_per_site = Counter(find_site_in_path(train_subject) for train_subject in train_converted)
     # Print number of train images per site
     for site, num_images in train_images_per_site.items():
         logger.info(f"Number of training and validation images in {site}: {num_images}")
 
     logger.info(f"Number of test images (across all sites): {test_ctr}")
     # Get number of test images per site
-    test_images_per_site = {}
-    for test_subject in test_images:
-        site = find_site_in_path(test_subject)
-        if site in test_images_per_site:
-            test_images_per_site[site] += 1
-        else:
-            test_images_per_site[site] = 1
+    test_images_per_site = Counter(find_site_in_path(test_subject) for test_subject in test_converted)
     # Print number of test images per site
     for site, num_images in test_images_per_site.items():
         logger.info(f"Number of test images in {site}: {num_images}")
@@ -2,6 +2,7 @@ import os
 import nibabel as nib
 import numpy as np
 import logging
+import shutil
 from copy import deepcopy
 import subprocess
 
@@ -56,39 +57,125 @@ def create_region_based_label(lesion_label_file, seg_label_file, image_file, sub
     return label_nii
 
 
-def create_multi_channel_label_input(lesion_label_file, seg_label_file, image_file, sub_ses_name, thr=0.5):
+def fast_copy(src, dst):
     """
-    Ensures lesion seg is part of SC seg (which will be the 2nd channel) in multi-channel input for nnUNet training. 
-    The label has 1 single channel --> 0: background, 1: lesion seg
-    The input has 2 channels --> image and spinal cord seg
+    Copy `src` to `dst` as a new, independent file.
+    Uses `os.copy_file_range` when available, which lets the kernel copy the data without going through user space
+    (or even share the data blocks, i.e. reflink, on filesystems such as Btrfs or XFS). Falls back to
+    `shutil.copyfile` otherwise (e.g., when `src` and `dst` are on different filesystems).
+    NOTE: a hardlink is deliberately not used -- the copied labels are overwritten in-place later on (e.g., by
+    `binarize_label`), which would modify the original file in the source dataset.
     """
-    # load the labels
-    lesion_label_npy = nib.load(lesion_label_file).get_fdata()
-    seg_label_npy = nib.load(seg_label_file).get_fdata()
+    if hasattr(os, 'copy_file_range'):
+        try:
+            with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+                remaining = os.fstat(fsrc.fileno()).st_size
+                while remaining > 0:
+                    copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), remaining)
+                    if copied == 0:
+                        break
+                    remaining -= copied
+            if remaining == 0:
+                return
+        except OSError:
+            pass
+    shutil.copyfile(src, dst)
+
+
+def as_reoriented(img, ornt):
+    """
+    Reorient the nibabel image `img` using the axis transform `ornt` (see `nib.orientations.ornt_transform`).
+    Unlike `img.as_reoriented(ornt)` alone:
+     - the stored (unscaled) voxel values are reoriented and the scl_slope/scl_inter of `img` are kept, i.e., the data
+       is neither upcast to float64 nor re-quantized with a newly computed scaling (e.g., for scaled int16 images)
+     - the qform and sform codes of `img` are kept (which resets the qform_code to 0 and the sform_code to 2 otherwise),
+       as done by `Image.change_orientation` (i.e., a code of 0 becomes 2 (aligned))
+    """
+    # identity transform (same check as in `img.as_reoriented`)
+    if np.array_equal(ornt, [[0, 1], [1, 1], [2, 1]]):
+        return img
 
-    # binarize the labels
-    lesion_label_npy = np.where(lesion_label_npy > thr, 1, 0)
-    seg_label_npy = np.where(seg_label_npy > thr, 1, 0)
+    img_unscaled = img.__class__(img.dataobj.get_unscaled(), img.affine, img.header)
+    img_reoriented = img_unscaled.as_reoriented(ornt)
+    img_reoriented.header.set_slope_inter(img.dataobj.slope, img.dataobj.inter)
+    img_reoriented.header.set_qform(img_reoriented.affine, int(img.header['qform_code']) or 2)
+    img_reoriented.header.set_sform(img_reoriented.affine, int(img.header['sform_code']) or 2)
 
-    # check if the shapes of the labels match
-    assert lesion_label_npy.shape == seg_label_npy.shape, \
-        f'Shape mismatch between lesion label and segmentation label for subject {sub_ses_name}. Check the labels.'
+    return img_reoriented
 
-    # create a new label array with the same shape as the original labels
-    label_npy = np.zeros(lesion_label_npy.shape, dtype=np.int16)
-    # spinal cord
-    label_npy[seg_label_npy == 1] = 1
-    # lesion seg
-    label_npy[lesion_label_npy == 1] = 1
 
-    # print unique values in the label array
-    # print(f'Unique values in the label array for subject {sub_ses_name}: {np.unique(label_npy)}')
+def reorient_and_save(src, dst, orientation="RPI", backend="nibabel"):
+    """
+    Reorient the image `src` to `orientation` and save it directly to `dst`, i.e. without first copying `src` to `dst`.
+    If the image is already in the requested orientation, the file is simply copied using `fast_copy` (a raw byte copy
+    is faster than decompressing and recompressing the data).
 
-    # save the new label file
-    ref = nib.load(image_file)
-    label_nii = nib.Nifti1Image(label_npy, ref.affine, ref.header)
+    :param orientation: orientation string (SCT "from" convention)
+    :param backend: 'nibabel' (default) permutes/flips the axes of the stored voxel array using nibabel's orientation
+                    tools, keeping the on-disk dtype and scl_slope/scl_inter (see `as_reoriented`); 'image' uses the
+                    `Image` class (which loads the scaled data and deep-copies it on save)
+    """
+    if backend not in ("nibabel", "image"):
+        raise ValueError(f"Unknown backend '{backend}'. Choose either 'nibabel' or 'image'.")
+
+    # nib.load is lazy, i.e., only the header is read here (the voxel data is not decompressed)
+    img = nib.load(src)
+    # SCT and nibabel use opposite orientation conventions (e.g., SCT 'RPI' == nibabel 'LAS')
+    axcodes = orientation_string_nib2sct(orientation)
+    if "".join(nib.orientations.aff2axcodes(img.affine)) == axcodes:
+        fast_copy(src, dst)
+        return
+
+    if backend == "nibabel":
+        ornt = nib.orientations.ornt_transform(nib.orientations.io_orientation(img.affine),
+                                               nib.orientations.axcodes2ornt(axcodes))
+        as_reoriented(img, ornt).to_filename(dst)
+    else:
+        Image(src).change_orientation(orientation).save(dst)
 
-    return label_nii
+
+def convert_subject_fused(image_src, lesion_src, seg_src, image_dst, sc_dst, lesion_dst, orientation="RPI", thr=0.5):
+    """
+    Multi-channel conversion of a single subject in a single pass: the image, lesion seg and spinal cord seg are each
+    loaded (decompressed) only once, and the three outputs are reoriented with the same axis transform (computed from
+    the image affine) and written directly to their destination:
+    image_dst: the image (with its stored dtype and scl_slope/scl_inter, see `as_reoriented`)
+    sc_dst: binary spinal cord seg including the lesion seg (2nd input channel)
+    lesion_dst: binary lesion seg (label)
+
+    :param orientation: orientation string (SCT "from" convention)
+    """
+    image_nii = nib.load(image_src)
+    lesion_nii = nib.load(lesion_src)
+    seg_nii = nib.load(seg_src)
+
+    # check if the shapes of the image and labels match (read from the headers only)
+    assert image_nii.shape == lesion_nii.shape == seg_nii.shape, \
+        f'Shape mismatch between the image, lesion label and segmentation label for {os.path.basename(image_src)}. ' \
+        f'Check the labels.'
+
+    # compute the axis transform once and apply it to the image and both masks
+    # NOTE: SCT and nibabel use opposite orientation conventions (e.g., SCT 'RPI' == nibabel 'LAS')
+    ornt = nib.orientations.ornt_transform(nib.orientations.io_orientation(image_nii.affine),
+                                           nib.orientations.axcodes2ornt(orientation_string_nib2sct(orientation)))
+    image_nii_reoriented = as_reoriented(image_nii, ornt)
+    if image_nii_reoriented is image_nii:
+        # already in the requested orientation, no need to decompress and recompress the image
+        fast_copy(image_src, image_dst)
+    else:
+        image_nii_reoriented.to_filename(image_dst)
+
+    # binarize the labels directly on the stored dtype; the lesion seg is part of the spinal cord seg
+    lesion_npy = np.asanyarray(lesion_nii.dataobj) > thr
+    sc_npy = (np.asanyarray(seg_nii.dataobj) > thr) | lesion_npy
+
+    for mask_npy, dst in ((sc_npy, sc_dst), (lesion_npy, lesion_dst)):
+        mask_npy = nib.orientations.apply_orientation(mask_npy, ornt).astype(np.uint8)
+        mask_nii = nib.Nifti1Image(mask_npy, image_nii_reoriented.affine, image_nii_reoriented.header)
+        # the masks are binary, i.e., the scaling of the image does not apply
+        mask_nii.set_data_dtype(np.uint8)
+        mask_nii.header.set_slope_inter(1, 0)
+        mask_nii.to_filename(dst)
 
 
 def get_git_branch_and_commit(dataset_path=None):
@@ -14,8 +14,19 @@ Example usage:
     python 02_read_xls_files.py -dir <DIR_NAME>/results -branch PR4656 -pred-type GT
     python 02_read_xls_files.py -dir <DIR_NAME>/results -branch PR4656 -pred-type SCIsegV2
 
+Several branches can be processed in a single run (one results folder per branch, in the same order):
+    python 02_read_xls_files.py -dir <DIR_NAME_master>/results <DIR_NAME_PR4656>/results -branch master PR4656 -pred-type GT
+
 Note: to read XLS files, you might need to install the following packages:
     pip install openpyxl
+If installed, the faster Rust-based python-calamine reader is used instead of openpyxl:
+    pip install python-calamine
+
+Note: the lesion metrics are cached in the output folder (as a Parquet file) so that only new or modified XLS files
+are read in the next runs. The cache requires the following package (without it, all XLS files are read every time):
+    pip install pyarrow
+Similarly, the list of XLS files is saved in the output folder (as a JSON manifest) and the input folder is listed
+again only if its content has changed (i.e., if its modification time differs).
 
 Author: Jan Valosek
 """
@@ -23,12 +34,24 @@ Author: Jan Valosek
 import os
 import sys
 import re
-import glob
+import time
+import json
+import tempfile
 import argparse
+import cProfile
+import pstats
 import logging
+from logging.handlers import MemoryHandler
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 import numpy as np
 import pandas as pd
+from openpyxl import load_workbook
+# optional faster XLS reader (falls back to openpyxl otherwise)
+try:
+    from python_calamine import CalamineWorkbook
+except ImportError:
+    CalamineWorkbook = None
 
 
 # Initialize logging
@@ -37,6 +60,10 @@ logger.setLevel(logging.INFO)  # default: logging.DEBUG, logging.INFO
 hdlr = logging.StreamHandler(sys.stdout)
 logging.root.addHandler(hdlr)
 
+# Subject and session IDs: 'sub-'/'ses-' followed by everything up to the next underscore or slash (excluded)
+_SUBJECT_RE = re.compile(r'(sub-[^_/]*)[_/]')
+_SESSION_RE = re.compile(r'(ses-[^_/]*)[_/]')
+
 
 def get_parser():
     """
@@ -51,17 +78,20 @@ def get_parser():
     parser.add_argument(
         '-dir',
         required=True,
+        nargs='+',
         type=str,
         help='Absolute path to the \'results\' folder with XLS files generated using \'sct_analyze_lesion. '
              'The results folders were generated using the \'01_compute_midsagittal_lesion_length_and_width.sh\' '
-             'script.'
+             'script. Several folders can be provided (one per branch, in the same order as -branch).'
     )
     parser.add_argument(
         '-branch',
         required=True,
+        nargs='+',
         type=str,
         help='Branch name (e.g., master or PR4631) with the XLS files with lesion metrics generated by '
-             'SCT\'s sct_analyze_lesion. This information will be included in the output CSV filename.'
+             'SCT\'s sct_analyze_lesion. This information will be included in the output CSV filename. '
+             'Several branches can be provided (one per folder passed to -dir), e.g., -branch master PR4631.'
     )
     parser.add_argument(
         '-pred-type',
@@ -77,6 +107,36 @@ def get_parser():
         default='stats',
         help='Path to the output folder where XLS table will be saved. Default: ./stats'
     )
+    parser.add_argument(
+        '-no-cache',
+        action='store_true',
+        help='Do not use the list of XLS files and the lesion metrics cached (in the output folder) during the previous '
+             'runs, i.e., list the input folders and read all XLS files again.'
+    )
+    parser.add_argument(
+        '-workers',
+        required=False,
+        type=int,
+        default=None,
+        help='Number of workers used to read the XLS files in parallel. Default: number of CPUs for processes, '
+             'min(32, number of CPUs + 4) for threads'
+    )
+    parser.add_argument(
+        '-io-mode',
+        required=False,
+        type=str,
+        choices=['process', 'thread'],
+        default='process',
+        help='Read the XLS files in parallel using processes (faster when parsing dominates, e.g., local SSD) or '
+             'threads (faster when reading dominates, e.g., network storage such as NFS). Default: process'
+    )
+    parser.add_argument(
+        '-profile',
+        action='store_true',
+        help='Profile the script using cProfile and print the 40 most expensive functions (sorted by cumulative time). '
+             'Note that the XLS files are read by workers which are not profiled; their time is included in the '
+             'waiting for the results of the executor.'
+    )
 
     return parser
 
@@ -91,49 +151,107 @@ def fetch_subject(filename_path):
     :return: sessionID: session ID (e.g., ses-01)
     """
 
-    subject = re.search('sub-(.*?)[_/]', filename_path)     # [_/] means either underscore or slash
-    subjectID = subject.group(0)[:-1] if subject else ""    # [:-1] removes the last underscore or slash
+    subject = _SUBJECT_RE.search(filename_path)
+    subjectID = subject.group(1) if subject else ""     # group(1) excludes the last underscore or slash
 
-    session = re.search('ses-(.*?)[_/]', filename_path)     # [_/] means either underscore or slash
-    sessionID = session.group(0)[:-1] if session else ""    # [:-1] removes the last underscore or slash
+    session = _SESSION_RE.search(filename_path)
+    sessionID = session.group(1) if session else ""     # group(1) excludes the last underscore or slash
 
     # REGEX explanation
-    # . - match any character (except newline)
-    # *? - match the previous element as few times as possible (zero or more times)
+    # [^_/]* - match any character except underscore and slash (zero or more times)
+    # [_/] - match either underscore or slash
 
     return subjectID, sessionID
 
 
-def get_fnames(dir_path, pred_type, column_name):
+def read_manifest(fname_manifest, dir_path):
+    """
+    Read the list of XLS files found in the input folder during the previous run
+    :param fname_manifest: path to the JSON file with the list of XLS files
+    :param dir_path: path to the folder with XLS files
+    :return: list of absolute paths to the XLS files, or None if the manifest does not exist or the folder has changed
+    since
+    """
+    if fname_manifest is None or not os.path.isfile(fname_manifest):
+        return None
+    # Any problem with the manifest (e.g., a corrupted file) is treated as a cache miss
+    try:
+        with open(fname_manifest) as f:
+            manifest = json.load(f)
+        dir_manifest, dir_mtime_ns, fname_files = manifest['dir'], manifest['dir_mtime_ns'], manifest['files']
+    except Exception as e:
+        logger.warning(f'WARNING: Cannot read the manifest {fname_manifest} ({e}). The input folder will be listed.')
+        return None
+    # Adding, removing or renaming a file updates the mtime of the folder
+    if dir_manifest != os.path.abspath(dir_path) or dir_mtime_ns != os.stat(dir_path).st_mtime_ns:
+        return None
+
+    return fname_files
+
+
+def write_manifest(fname_manifest, dir_path, dir_mtime_ns, fname_files):
+    """
+    Save the list of XLS files found in the input folder to avoid listing the folder again in the next runs
+    :param fname_manifest: path to the JSON file with the list of XLS files
+    :param dir_path: path to the folder with XLS files
+    :param dir_mtime_ns: mtime of the folder (in ns) before it was listed
+    :param fname_files: list of absolute paths to the XLS files
+    """
+    # Write to a temporary file first and then replace the manifest (see write_cache())
+    fd, fname_tmp = tempfile.mkstemp(suffix='.json', dir=os.path.dirname(fname_manifest))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'dir': os.path.abspath(dir_path), 'dir_mtime_ns': dir_mtime_ns, 'files': fname_files}, f,
+                      indent=4)
+        os.replace(fname_tmp, fname_manifest)
+    finally:
+        if os.path.exists(fname_tmp):
+            os.remove(fname_tmp)
+
+
+def get_fnames(dir_path, pred_type, column_name, fname_manifest=None):
     """
     Get list of XLS files with lesion metrics
     :param dir_path: list of paths to XLS files with lesion metrics
     :param pred_type: GT or SCIsegV2
     :param column_name: branch name (e.g., master or PR4631)
+    :param fname_manifest: path to the JSON file with the list of XLS files found during the previous run; the folder
+    is listed only if the manifest is missing or outdated (and the manifest is then updated). None: always list
     :return: pandas dataframe with the paths to the XLS files
     """
 
-    # Get XLS files with lesion metrics
-    if pred_type == 'GT':
-        fname_files = glob.glob(os.path.join(dir_path, '*lesion-manual_bin_analysis.xls'))
-    elif pred_type == 'SCIsegV2':
-        fname_files = glob.glob(os.path.join(dir_path, '*lesion_seg_analysis_SCIsegV2.xls'))
+    fname_files = read_manifest(fname_manifest, dir_path)
+    if fname_files is None:
+        # Get XLS files with lesion metrics
+        if pred_type == 'GT':
+            suffix = 'lesion-manual_bin_analysis.xls'
+        elif pred_type == 'SCIsegV2':
+            suffix = 'lesion_seg_analysis_SCIsegV2.xls'
+
+        # Single pass over the directory; hidden files starting with '~' or '.' (skipped by glob) are removed
+        # NOTE: the mtime is taken before listing so that files added meanwhile invalidate the manifest
+        # NOTE: the paths are absolute so that the manifest can be reused from another working directory
+        dir_mtime_ns = os.stat(dir_path).st_mtime_ns
+        with os.scandir(os.path.abspath(dir_path)) as entries:
+            fname_files = [entry.path for entry in entries
+                           if entry.name.endswith(suffix) and not entry.name.startswith(('~', '.')) and
+                           entry.is_file()]
+
+        # Sort the list of file names (to make the list the same when provided the input folders in different order)
+        fname_files.sort()
+        if fname_manifest is not None:
+            write_manifest(fname_manifest, dir_path, dir_mtime_ns, fname_files)
 
-    # remove hidden files starting with '~'
-    fname_files = [f for f in fname_files if not os.path.basename(f).startswith('~')]
     # if fname_files is empty, exit
     if len(fname_files) == 0:
         print(f'ERROR: No XLS files found in {dir_path}')
 
-    # Sort the list of file names (to make the list the same when provided the input folders in different order)
-    fname_files.sort()
-
     # Convert fname_files_all into pandas dataframe
     df = pd.DataFrame(fname_files, columns=[column_name])
 
-    # Add a column with participant_id and session_id
-    df['participant_id'] = df[column_name].apply(lambda x: fetch_subject(x)[0])
-    df['session_id'] = df[column_name].apply(lambda x: fetch_subject(x)[1])
+    # Add a column with participant_id and session_id (vectorized equivalent of fetch_subject())
+    df['participant_id'] = df[column_name].str.extract(_SUBJECT_RE.pattern, expand=False).fillna('')
+    df['session_id'] = df[column_name].str.extract(_SESSION_RE.pattern, expand=False).fillna('')
     # Reorder the columns
     df = df[['participant_id', 'session_id', column_name]]
     print(f'Number of participants: {len(df)}')
@@ -141,59 +259,218 @@ def get_fnames(dir_path, pred_type, column_name):
     return df
 
 
-def fetch_lesion_metrics(index, row, branch, df):
+def read_measures_sheet(fname_xls):
     """
-    Fetch lesion metrics from the XLS file with lesion metrics generated by sct_analyze_lesion
-    :param index: index of the dataframe
-    :param row: row of the dataframe (one row corresponds to one participant)
-    :param branch: master or PR4631
-    :param df: dataframe with the paths to the XLS files for manual and predicted lesions
-    :return: df: updated dataframe with the paths to the XLS files for manual and predicted lesions and lesion metrics
+    Read the 'measures' sheet of the XLS file with lesion metrics generated by sct_analyze_lesion. Only the cell values
+    are read (using python-calamine if installed, otherwise openpyxl in read-only mode), i.e., without building the full
+    workbook DOM and a dataframe.
+    NOTE: sct_analyze_lesion saves the file in the xlsx format but with the '.xls' extension, which openpyxl refuses to
+    open from a path; hence, the file is passed as a file object.
+    :param fname_xls: path to the XLS file with lesion metrics
+    :return: columns: dict mapping the column names to their index
+    :return: rows: list of rows (one row corresponds to one lesion)
+    """
+    with open(fname_xls, 'rb') as f:
+        if CalamineWorkbook is not None:
+            sheet = CalamineWorkbook.from_filelike(f).get_sheet_by_name('measures').to_python(skip_empty_area=False)
+            header = sheet[0]
+            # calamine returns '' for empty cells; use None as openpyxl does
+            rows = [tuple(None if value == '' else value for value in row) for row in sheet[1:]]
+        else:
+            wb = load_workbook(f, read_only=True, data_only=True)
+            try:
+                rows = wb['measures'].iter_rows(values_only=True)
+                header = next(rows)
+                rows = list(rows)
+            finally:
+                wb.close()
+    # skip empty rows
+    rows = [row for row in rows if any(value is not None for value in row)]
+    columns = {name: idx for idx, name in enumerate(header)}
+
+    return columns, rows
+
+
+def get_columns(columns, rows, names, optional=()):
+    """
+    Get the values of given columns across all rows (i.e., lesions) as a float pandas DataFrame (one column per name).
+    The column indices are resolved once and the values of all columns are gathered in a single pass over the rows.
+    :param columns: dict mapping the column names to their index
+    :param rows: list of rows (one row corresponds to one lesion)
+    :param names: names of the columns to get
+    :param optional: names of the columns which might be missing in the XLS file (their values are NaN); other missing
+    columns raise a KeyError
+    :return: pandas DataFrame with the values (empty cells are NaN)
     """
+    idx = [columns.get(name, -1) if name in optional else columns[name] for name in names]
+    values = np.array([[row[i] if 0 <= i < len(row) else None for i in idx] for row in rows], dtype=float)
+    return pd.DataFrame(values.reshape(len(rows), len(names)), columns=names)
 
-    # Check if the XLS file with lesion metrics for manual lesion exists
-    if not os.path.exists(row[branch]):
-        raise ValueError(f'ERROR: {row[+branch]} does not exist.')
+
+def fetch_lesion_metrics(fname_xls):
+    """
+    Fetch lesion metrics from the XLS file with lesion metrics generated by sct_analyze_lesion
+    :param fname_xls: path to the XLS file with lesion metrics (one file corresponds to one participant)
+    :return: metrics: dict with the lesion metrics (keys correspond to the column names of the output dataframe)
+    """
 
     # Read the XLS file with lesion metrics for lesion predicted by our 3D SCIseg nnUNet model
-    df_lesion = pd.read_excel(row[branch], sheet_name='measures')
-    if len(df_lesion) > 1:
-        print(f'Subject: {row["participant_id"]} has more than one lesion. Aggregating the metrics across lesions.')
+    columns, rows = read_measures_sheet(fname_xls)
+    if len(rows) > 1:
+        print(f'Subject: {fetch_subject(fname_xls)[0]} has more than one lesion. Aggregating the metrics across '
+              f'lesions.')
+
+    # The tissue bridges are read from the columns of the midsagittal slice
+    midsagittal_slice = None
+    bridge_columns = []
+    if 'midsagittal_slice' in columns:
+        midsagittal_slice = rows[0][columns['midsagittal_slice']]
+        # openpyxl returns floats for whole numbers stored as floats, e.g., 12.0 --> 12
+        if isinstance(midsagittal_slice, float) and midsagittal_slice.is_integer():
+            midsagittal_slice = int(midsagittal_slice)
+        midsagittal_slice = str(midsagittal_slice)
+        bridge_columns = ['slice_' + midsagittal_slice + '_dorsal_bridge_width [mm]',
+                          'slice_' + midsagittal_slice + '_ventral_bridge_width [mm]']
+
+    # Get all the needed columns at once; the bridge columns might be missing (e.g., no bridges at the midsagittal
+    # slice), in which case their values are NaN
+    values = get_columns(columns, rows,
+                         ['length [mm]', 'width [mm]', 'length_interpolated_midsagittal_slice [mm]',
+                          'width_interpolated_midsagittal_slice [mm]'] + bridge_columns,
+                         optional=bridge_columns)
+
     # Get the metrics
-    # Sum midsagittal length and "3D" length
-    midsagittal_length = df_lesion['length_interpolated_midsagittal_slice [mm]'].sum()
-    length = df_lesion['length [mm]'].sum()
-    # Take max width
-    midsagittal_width = df_lesion['width_interpolated_midsagittal_slice [mm]'].max()
-    width = df_lesion['width [mm]'].max()
-
-    # Save the values in the currently processed df row
-    df.at[index, 'length'] = length
-    df.at[index, 'width'] = width
-    df.at[index, 'midsagittal_length'] = midsagittal_length
-    df.at[index, 'midsagittal_width'] = midsagittal_width
-
-    if 'midsagittal_slice' in df_lesion.columns:
-        # midsagittal_slice = str(df_lesion['midsagittal_spinal_cord_slice'].values[0])
-        midsagittal_slice = str(df_lesion['midsagittal_slice'].values[0])
-        # Check if 'slice_' + midsagittal_slice + '_dorsal_bridge_width [mm]' is in the columns
-        if 'slice_' + midsagittal_slice + '_dorsal_bridge_width [mm]' in df_lesion.columns:
-            # Take min for dorsal and ventral bridges
-            dorsal_tissue_bridge = df_lesion['slice_' + midsagittal_slice + '_dorsal_bridge_width [mm]'].min()
-            ventral_tissue_bridge = df_lesion['slice_' + midsagittal_slice + '_ventral_bridge_width [mm]'].min()
-        else:
-            dorsal_tissue_bridge = np.nan
-            ventral_tissue_bridge = np.nan
-        # Save the values in the currently processed df row
-        df.at[index, 'midsagittal_slice'] = midsagittal_slice
-        df.at[index, 'dorsal_tissue_bridge'] = dorsal_tissue_bridge
-        df.at[index, 'ventral_tissue_bridge'] = ventral_tissue_bridge
+    metrics = {}
+    # Sum midsagittal length and "3D" length, take max midsagittal width and "3D" width
+    metrics['length'] = values['length [mm]'].sum()
+    metrics['width'] = values['width [mm]'].max()
+    metrics['midsagittal_length'] = values['length_interpolated_midsagittal_slice [mm]'].sum()
+    metrics['midsagittal_width'] = values['width_interpolated_midsagittal_slice [mm]'].max()
 
-    if 'interpolated_midsagittal_slice' in df_lesion.columns:
-        df.at[index, 'dorsal_tissue_bridge'] = df_lesion['interpolated_dorsal_bridge_width [mm]'].values[0]
-        df.at[index, 'ventral_tissue_bridge'] = df_lesion['interpolated_ventral_bridge_width [mm]'].values[0]
+    if midsagittal_slice is not None:
+        metrics['midsagittal_slice'] = midsagittal_slice
+        # Take min for dorsal and ventral bridges
+        metrics['dorsal_tissue_bridge'] = values[bridge_columns[0]].min()
+        metrics['ventral_tissue_bridge'] = values[bridge_columns[1]].min()
 
-    return df
+    if 'interpolated_midsagittal_slice' in columns:
+        bridges = get_columns(columns, rows, ['interpolated_dorsal_bridge_width [mm]',
+                                              'interpolated_ventral_bridge_width [mm]']).iloc[0]
+        metrics['dorsal_tissue_bridge'] = bridges['interpolated_dorsal_bridge_width [mm]']
+        metrics['ventral_tissue_bridge'] = bridges['interpolated_ventral_bridge_width [mm]']
+
+    return metrics
+
+
+def read_cache(fname_cache):
+    """
+    Read the cache with lesion metrics of the XLS files processed during the previous runs
+    :param fname_cache: path to the Parquet file with the cached lesion metrics
+    :return: cache: dict mapping the XLS file path to a tuple (mtime of the XLS file in ns, dict with lesion metrics)
+    """
+    if not os.path.isfile(fname_cache):
+        return {}
+    # Any problem with the cache (e.g., no Parquet engine or a corrupted file) is treated as a cache miss
+    try:
+        df_cache = pd.read_parquet(fname_cache)
+        cache = {}
+        for record in df_cache.to_dict(orient='records'):
+            fname_xls = record.pop('fname_xls')
+            mtime_ns = record.pop('mtime_ns')
+            cache[fname_xls] = (mtime_ns, record)
+    except Exception as e:
+        logger.warning(f'WARNING: Cannot read the cache {fname_cache} ({e}). All XLS files will be read.')
+        return {}
+
+    return cache
+
+
+def write_cache(fname_cache, cache):
+    """
+    Save the lesion metrics of the processed XLS files to a Parquet file to avoid parsing them again in the next runs
+    :param fname_cache: path to the Parquet file with the cached lesion metrics
+    :param cache: dict mapping the XLS file path to a tuple (mtime of the XLS file in ns, dict with lesion metrics)
+    """
+    df_cache = pd.DataFrame([{'fname_xls': fname_xls, 'mtime_ns': mtime_ns, **metrics}
+                             for fname_xls, (mtime_ns, metrics) in cache.items()])
+    # Write to a temporary file first and then replace the cache, so that an interrupted run does not leave a truncated
+    # cache behind
+    fd, fname_tmp = tempfile.mkstemp(suffix='.parquet', dir=os.path.dirname(fname_cache))
+    os.close(fd)
+    try:
+        df_cache.to_parquet(fname_tmp, compression='zstd', index=False)
+        os.replace(fname_tmp, fname_cache)
+    except ImportError as e:
+        logger.warning(f'WARNING: Cannot write the cache {fname_cache} ({e}).')
+    finally:
+        if os.path.exists(fname_tmp):
+            os.remove(fname_tmp)
+
+
+def process_branch(dir_path, branch_name, pred_type, output_dir, executor, use_cache=True):
+    """
+    Read the XLS files with lesion metrics of one branch and save the aggregated lesion metrics to a CSV file
+    :param dir_path: path to the 'results' folder with XLS files
+    :param branch_name: branch name (e.g., master or PR4631)
+    :param pred_type: GT or SCIsegV2
+    :param output_dir: path to the output folder
+    :param executor: process or thread pool executor used to read the XLS files in parallel (shared across branches)
+    :param use_cache: whether to use the list of XLS files and the lesion metrics cached during the previous runs
+    """
+
+    # Check if the input path exists
+    if not os.path.exists(dir_path):
+        raise ValueError(f'ERROR: {dir_path} does not exist.')
+
+    start = time.time()
+
+    # For each participant_id, get XLS files with lesion metrics
+    fname_manifest = os.path.join(output_dir, f'xls_manifest_{pred_type}_{branch_name}.json')
+    df = get_fnames(dir_path, pred_type, column_name=branch_name, fname_manifest=fname_manifest if use_cache else None)
+
+    # Remove sub-zh111 from the list of participants (it has multiple lesions)
+    df = df[df['participant_id'] != 'sub-zh111']
+
+    # Load the lesion metrics cached during the previous runs; only the new or modified XLS files are read again
+    fname_cache = os.path.join(output_dir, f'xls_cache_{pred_type}_{branch_name}.parquet')
+    cache = read_cache(fname_cache) if use_cache else {}
+    fnames_xls = df[branch_name].tolist()
+    mtimes_ns = {fname_xls: os.stat(fname_xls).st_mtime_ns for fname_xls in fnames_xls}
+    fnames_xls_to_read = [fname_xls for fname_xls in fnames_xls
+                          if fname_xls not in cache or cache[fname_xls][0] != mtimes_ns[fname_xls]]
+    logger.info(f'Reading {len(fnames_xls_to_read)} XLS files ({len(fnames_xls) - len(fnames_xls_to_read)} cached)')
+
+    # Read the XLS files (one per participant) with lesion metrics in parallel
+    results = executor.map(fetch_lesion_metrics, fnames_xls_to_read, chunksize=4)
+    for fname_xls, metrics in zip(fnames_xls_to_read, results):
+        cache[fname_xls] = (mtimes_ns[fname_xls], metrics)
+
+    records = [cache[fname_xls][1] for fname_xls in fnames_xls]
+    logger.info(f'Processed XLS files for {len(records)} participants in {time.time() - start:.1f} s')
+
+    # Update the cache (keep only the currently processed XLS files)
+    write_cache(fname_cache, {fname_xls: cache[fname_xls] for fname_xls in fnames_xls})
+
+    # Build the dataframe with lesion metrics of all participants at once and join it to the participant and session
+    # IDs (the branch column containing the paths to the XLS files is not selected)
+    metrics_df = pd.DataFrame(records, index=df.index)
+    df = df[['participant_id', 'session_id']].join(metrics_df)
+
+    # Use compact dtypes: the IDs are repeated strings and the midsagittal slice is a small integer (stored as string)
+    df['participant_id'] = df['participant_id'].astype('category')
+    df['session_id'] = df['session_id'].astype('category')
+    if 'midsagittal_slice' in df.columns:
+        df['midsagittal_slice'] = pd.to_numeric(df['midsagittal_slice'], errors='coerce').astype('Int16')
+    # Save the dataframe with lesion metrics to a CSV file
+    df.to_csv(os.path.join(output_dir, f'lesion_metrics_{pred_type}_{branch_name}.csv'), index=False)
+    logger.info(f'Saved lesion metrics to {output_dir}/lesion_metrics_{pred_type}_{branch_name}.csv')
+    # Save also a Parquet file (typed and faster to load than the CSV file, e.g., using pd.read_parquet)
+    try:
+        df.to_parquet(os.path.join(output_dir, f'lesion_metrics_{pred_type}_{branch_name}.parquet'),
+                      compression='zstd', index=False)
+        logger.info(f'Saved lesion metrics to {output_dir}/lesion_metrics_{pred_type}_{branch_name}.parquet')
+    except ImportError as e:
+        logger.warning(f'WARNING: Cannot save the lesion metrics to a Parquet file ({e}).')
 
 
 def main():
@@ -201,7 +478,8 @@ def main():
     parser = get_parser()
     args = parser.parse_args()
 
-    branch_name = args.branch
+    if len(args.dir) != len(args.branch):
+        parser.error(f'-dir and -branch must have the same number of values ({len(args.dir)} != {len(args.branch)})')
     pred_type = args.pred_type
 
     # Output directory
@@ -217,29 +495,25 @@ def main():
     fh = logging.FileHandler(os.path.join(os.path.abspath(output_dir), fname_log))
     logging.root.addHandler(fh)
 
-    # Check if the input path exists
-    if not os.path.exists(args.dir):
-        raise ValueError(f'ERROR: {args.dir} does not exist.')
-
-    # For each participant_id, get XLS files with lesion metrics
-    df = get_fnames(args.dir, pred_type, column_name=branch_name)
-
-    # Remove sub-zh111 from the list of participants (it has multiple lesions)
-    df = df[df['participant_id'] != 'sub-zh111']
-
-    # Iterate over the rows of the dataframe and read the XLS files
-    for index, row in df.iterrows():
-
-        logger.info(f'Processing XLS files for {row["participant_id"]}')
-
-        # Read the XLS file with lesion metrics
-        df = fetch_lesion_metrics(index, row, branch_name, df)
-
-    # remove the branch column containing the paths to the XLS files
-    df.drop(columns=[branch_name], inplace=True)
-    # Save the dataframe with lesion metrics to a CSV file
-    df.to_csv(os.path.join(output_dir, f'lesion_metrics_{pred_type}_{branch_name}.csv'), index=False)
-    logger.info(f'Saved lesion metrics to {output_dir}/lesion_metrics_{pred_type}_{branch_name}.csv')
+    # Buffer the stdout logging; the buffer is flushed when full, on warnings and at the end
+    mh = MemoryHandler(1024, flushLevel=logging.WARNING, target=hdlr)
+    logging.root.removeHandler(hdlr)
+    logging.root.addHandler(mh)
+
+    if args.profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        # Process all branches with the same pool of workers
+        executor_class = ThreadPoolExecutor if args.io_mode == 'thread' else ProcessPoolExecutor
+        with executor_class(max_workers=args.workers) as executor:
+            for dir_path, branch_name in zip(args.dir, args.branch):
+                process_branch(dir_path, branch_name, pred_type, output_dir, executor, use_cache=not args.no_cache)
+    finally:
+        mh.flush()
+        if args.profile:
+            profiler.disable()
+            pstats.Stats(profiler, stream=sys.stdout).sort_stats('cumulative').print_stats(40)
 
 
 if __name__ == '__main__':
@@ -66,13 +66,13 @@ def get_parser():
         '-file1',
         required=True,
         type=str,
-        help='Absolute path to a CSV/XLSX file with lesion metrics for method 1.'
+        help='Absolute path to a CSV/XLSX/Parquet file with lesion metrics for method 1.'
     )
     parser.add_argument(
         '-file2',
         required=True,
         type=str,
-        help='Absolute path to a CSV/XLSX file with lesion metrics for method 2.'
+        help='Absolute path to a CSV/XLSX/Parquet file with lesion metrics for method 2.'
     )
     parser.add_argument(
         '-method1',
@@ -96,6 +96,20 @@ def get_parser():
     return parser
 
 
+def read_parquet(file):
+    """
+    Read Parquet file with lesion metrics saved by 02_read_xls_files.py
+    The IDs are stored as categoricals with '' for missing sessions; they are converted to strings with NaN for missing
+    sessions (as read from the CSV file) to be able to merge the dataframes
+    :param file: str: path to the Parquet file
+    :return: pd.DataFrame: dataframe with the metrics
+    """
+    df = pd.read_parquet(file)
+    df[['participant_id', 'session_id']] = df[['participant_id', 'session_id']].astype(str).replace('', np.nan)
+
+    return df
+
+
 def read_xlsx(file):
     """
     Read XLSX file with manually measured metrics
@@ -369,6 +383,8 @@ def main():
         df_method1 = read_xlsx(file1)
     elif file1.endswith('.csv'):
         df_method1 = pd.read_csv(file1)
+    elif file1.endswith('.parquet'):
+        df_method1 = read_parquet(file1)
 
     # Add suffix to all columns except participant_id and session_id
     df_method1 = df_method1.add_suffix(f'_{method1}')
@@ -382,6 +398,8 @@ def main():
         df_method2 = read_xlsx(file2)
     elif file2.endswith('.csv'):
         df_method2 = pd.read_csv(file2)
+    elif file2.endswith('.parquet'):
+        df_method2 = read_parquet(file2)
 
     # Add suffix to all columns except participant_id and session_id
     df_method2 = df_method2.add_suffix(f'_{method2}')